@@ -3,7 +3,7 @@
 @Date: Dec 2022
 """
 import uuid
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 class CustomisableInterestRateSwap(BaseModel):
@@ -103,12 +103,17 @@ class MarketScenario(BaseModel):
 class Loss(BaseModel):
     """
     To store losses.
+    ARGS:
+        trial_id:                   hyperparameter tuning trial, None outside tuning
+        trial_time_seconds:         wall clock time of the tuning trial
     """
     id: str = Field(default_factory=uuid.uuid4, alias="_id")
     model: str
     save_timestamp: str
     loss_name: str
     loss: List[float]
+    trial_id: Optional[str] = None
+    trial_time_seconds: Optional[float] = None
 
     class Config:
         orm_mode = True
@@ -10,14 +10,128 @@ from tensorflow.keras.utils import Sequence
 from tensorflow.keras.layers import Dense, GRU, LSTM
 from tensorflow.keras.optimizers import Adam
 from keras.callbacks import ModelCheckpoint
+import joblib
+import numpy as np
 from sklearn.ensemble import RandomForestRegressor
 from accelerated_model import *
 
-def get_random_forest():
+def get_random_forest(n_estimators: int = 100, max_depth: int = None, min_samples_leaf: int = 1,
+                      max_samples: float = None, n_jobs: int = -1):
     """
     Returns the random forest model.
+    ARGS:
+        n_estimators (int):               nbr of trees, grown further with warm start.
+        max_depth (int):                  max depth of the trees, None for unbounded trees.
+        min_samples_leaf (int):           min nbr of samples in a leaf, larger values give smaller trees.
+        max_samples (float):              fraction of samples drawn for each tree, None for all samples.
+        n_jobs (int):                     nbr of parallel jobs, -1 for all cores.
+    """
+    return RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth, min_samples_leaf=min_samples_leaf,
+                                 max_samples=max_samples, n_jobs=n_jobs, random_state=37, warm_start=True)
+
+def flatten_features(x, horizon: int):
+    """
+    Returns the features up to the horizon as a float32 design matrix for the random forest.
+    ARGS:
+        x (np.ndarray):                   features in shape (samples, MAX_PORTFOLIO_LIFETIME_MONTHS, NBR_FEATURES).
+        horizon (int):                    last time point (months) included in the features.
+    """
+    return np.asarray(x[:, :horizon + 1, :], dtype=np.float32).reshape(x.shape[0], -1)
+
+def get_horizons(horizon_step: int = None):
+    """
+    Returns the last time points (months) of the output blocks predicted by separate forests.
+    ARGS:
+        horizon_step (int):               nbr of months per block, 1 for a forest per time point,
+                                          None for a single forest over the whole profile.
+    """
+    if horizon_step is None:
+        return [MAX_PORTFOLIO_LIFETIME_MONTHS - 1]
+    if horizon_step <= 0:
+        raise ValueError("horizon_step must be positive, got " + str(horizon_step))
+    horizons = list(range(horizon_step - 1, MAX_PORTFOLIO_LIFETIME_MONTHS - 1, horizon_step))
+    return horizons + [MAX_PORTFOLIO_LIFETIME_MONTHS - 1]
+
+def train_random_forest(shards, models=None, estimators_per_shard: int = 10, horizon_step: int = None,
+                        max_depth: int = None, min_samples_leaf: int = 1, max_samples: float = None):
+    """
+    Returns random forests trained incrementally over the data shards. Each shard grows the forests
+    with new trees by warm start, so only one shard needs to be kept in memory at a time.
+    The exposure profile is split into blocks of horizon_step months, and the forest of a block is
+    trained only with the features up to the last month of the block.
+
+    ARGS:
+        shards (iterable):                (features, exposure profiles) tuples, e.g. a generator loading shards.
+        models (list):                    forests returned by train_random_forest to continue training,
+                                          None for new forests.
+        estimators_per_shard (int):       nbr of trees added per shard.
+        horizon_step (int):               nbr of months per block, see get_horizons.
+        max_depth (int):                  max depth of the trees of new forests, None for unbounded trees.
+        min_samples_leaf (int):           min nbr of samples in a leaf of new forests.
+        max_samples (float):              fraction of samples drawn for each tree of new forests, None for all samples.
+    """
+    if estimators_per_shard <= 0:
+        raise ValueError("estimators_per_shard must be positive, got " + str(estimators_per_shard))
+    horizons = get_horizons(horizon_step)
+    if models is None:
+        models = []
+        output_start = 0
+        for horizon in horizons:
+            model = get_random_forest(n_estimators=0, max_depth=max_depth, min_samples_leaf=min_samples_leaf,
+                                      max_samples=max_samples)
+            model.output_start_ = output_start
+            model.horizon_ = horizon
+            models.append(model)
+            output_start = horizon + 1
+    else:
+        if max_depth is not None or min_samples_leaf != 1 or max_samples is not None:
+            raise ValueError("Tree size limits can be given only for new forests")
+        if [getattr(model, 'horizon_', None) for model in models] != horizons:
+            raise ValueError("horizon_step does not match the horizons of the given forests")
+
+    nbr_shards = 0
+    for x, y in shards:
+        for model in models:
+            y_block = y[:, model.output_start_:model.horizon_ + 1]
+            if y_block.shape[1] == 1:
+                # Single output as 1-D array to avoid the column vector conversion warning
+                y_block = y_block[:, 0]
+            model.n_estimators += estimators_per_shard
+            model.fit(flatten_features(x, model.horizon_), y_block)
+        nbr_shards += 1
+    if nbr_shards == 0:
+        raise ValueError("No shards given for training the random forest")
+    return models
+
+def predict_random_forest(models, x, batch_size: int = 4096):
+    """
+    Returns the exposure profiles predicted by the forests of each block. Calculated in batches to
+    limit the memory usage.
+    ARGS:
+        models (list):                    forests returned by train_random_forest.
+        x (np.ndarray):                   features in shape (samples, MAX_PORTFOLIO_LIFETIME_MONTHS, NBR_FEATURES).
+        batch_size (int):                 nbr of samples predicted at once.
+    """
+    y_pred = np.empty((x.shape[0], MAX_PORTFOLIO_LIFETIME_MONTHS), dtype=np.float32)
+    for start in range(0, x.shape[0], batch_size):
+        x_batch = x[start:start + batch_size]
+        for model in models:
+            # predict returns a 1-D array for a single output
+            y_pred[start:start + batch_size, model.output_start_:model.horizon_ + 1] = \
+                model.predict(flatten_features(x_batch, model.horizon_)).reshape(-1, model.n_outputs_)
+    return y_pred
+
+def save_random_forest(models, filepath, compress: int = 3):
+    """
+    Saves the random forests compressed with joblib.
+    """
+    joblib.dump(models, filepath, compress=compress)
+
+def load_random_forest(filepath):
+    """
+    Loads the random forests saved with save_random_forest.
     """
-    return RandomForestRegressor(n_estimators=100, max_depth=None, n_jobs=-1, random_state=37, warm_start=True)
+    return joblib.load(filepath)
 
 def do_build(model):
     """
@@ -3,10 +3,25 @@
 @Date: Dec 2022
 """
 
+import os
+import json
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from datetime import datetime
+from functools import lru_cache
+import numpy as np
+import tensorflow as tf
+import keras_tuner as kt
 from tensorflow.keras.models import Sequential
+from tensorflow.keras.utils import Sequence
 from tensorflow.keras.layers import Dense, GRU, LSTM
 from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.callbacks import EarlyStopping
 from config_utils import *
+from data_generation.models import Loss
+
+TRIAL_RESULTS_FNAME = 'trial_results.json'
 
 def build_tuning_model_gru(hp):
     """
@@ -37,3 +52,172 @@ def build_tuning_model_lstm(hp):
     model.add(Dense(MAX_PORTFOLIO_LIFETIME_MONTHS))
     model.compile(optimizer=Adam(hp.Choice('learning_rate', values=[0.01, 0.001, 0.0001])), loss='mse')
     return model
+
+@lru_cache(maxsize=None)
+def load_dataset(x_filepath, y_filepath):
+    """
+    Loads the features and exposure profiles saved with np.save as memory mapped arrays.
+    Cached, so each worker process opens the files only once.
+    """
+    return np.load(x_filepath, mmap_mode='r'), np.load(y_filepath, mmap_mode='r')
+
+class MemmapBatchGenerator(Sequence):
+    """
+    Batch generator reading batches from memory mapped arrays, so the dataset is not copied
+    to each worker process.
+    """
+    def __init__(self, x, y, batch_size: int):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.x) / self.batch_size))
+
+    def __getitem__(self, idx):
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        return np.asarray(self.x[batch], dtype=np.float32), np.asarray(self.y[batch], dtype=np.float32)
+
+class TimedHyperband(kt.Hyperband):
+    """
+    Hyperband tuner which stores the wall clock time and the validation loss history of each trial
+    in the trial directory.
+    """
+    def run_trial(self, trial, *fit_args, **fit_kwargs):
+        start = time.time()
+        histories = super(TimedHyperband, self).run_trial(trial, *fit_args, **fit_kwargs)
+        # Keep the execution reaching the lowest validation loss
+        val_loss = min((h.history['val_loss'] for h in histories), key=min)
+        with open(os.path.join(self.get_trial_dir(trial.trial_id), TRIAL_RESULTS_FNAME), 'w') as f:
+            json.dump({'seconds': time.time() - start, 'val_loss': [float(l) for l in val_loss]}, f)
+        return histories
+
+def get_tuner(model_name: str, max_epochs: int, directory, project_name, overwrite: bool = False):
+    """
+    Returns Hyperband tuner for the GRU or LSTM model. Hyperband stops unpromising trials early
+    by successive halving on the validation loss.
+    ARGS:
+        model_name (str):                 'gru' or 'lstm'.
+        max_epochs (int):                 max nbr of epochs for a single model.
+    """
+    if model_name == 'gru':
+        hypermodel = build_tuning_model_gru
+    elif model_name == 'lstm':
+        hypermodel = build_tuning_model_lstm
+    else:
+        raise ValueError("Unknown model: " + str(model_name))
+    return TimedHyperband(hypermodel,
+                          objective='val_loss',
+                          max_epochs=max_epochs,
+                          factor=3,
+                          directory=directory,
+                          project_name=project_name,
+                          overwrite=overwrite)
+
+def _run_tuning_chief(model_name: str, max_epochs: int, directory, project_name):
+    """
+    Runs the chief oracle serving the trials to the workers. Does not return, the process is
+    terminated when the workers have finished.
+    """
+    get_tuner(model_name, max_epochs, directory, project_name)
+
+def _run_tuning_worker(threads_per_worker: int, model_name: str, max_epochs: int,
+                       directory, project_name, dataset_filepaths: tuple, batch_size: int):
+    """
+    Runs Hyperband trials given by the chief oracle in a worker process.
+    """
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    x_train, y_train = load_dataset(*dataset_filepaths[:2])
+    x_val, y_val = load_dataset(*dataset_filepaths[2:])
+    tuner = get_tuner(model_name, max_epochs, directory, project_name)
+    tuner.search(MemmapBatchGenerator(x_train, y_train, batch_size),
+                 validation_data=MemmapBatchGenerator(x_val, y_val, batch_size),
+                 callbacks=[EarlyStopping(monitor='val_loss', patience=3)],
+                 verbose=0)
+
+def _start_process(ctx, target, args, env: dict):
+    """
+    Starts a spawned process with the given environment variables. The variables are set only
+    while the process is started, as the spawned child copies the environment of this process.
+    """
+    saved_env = {key: os.environ.get(key) for key in env}
+    try:
+        os.environ.update(env)
+        process = ctx.Process(target=target, args=args)
+        process.start()
+    finally:
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return process
+
+def tune_model(model_name: str, dataset_filepaths: tuple, directory, project_name, workers: int = 4,
+               threads_per_worker: int = 2, max_epochs: int = 27, batch_size: int = 32,
+               oracle_port: int = 8000, overwrite: bool = False):
+    """
+    Runs the Hyperband search concurrently in worker processes with a chief oracle in its own process.
+    Returns the tuner and a Loss per trial with the validation loss history and the trial time.
+    ARGS:
+        model_name (str):                 'gru' or 'lstm'.
+        dataset_filepaths (tuple):        .npy filepaths of training features, training exposure profiles,
+                                          validation features and validation exposure profiles.
+        workers (int):                    nbr of worker processes running the trials.
+        threads_per_worker (int):         nbr of CPU threads of a single worker.
+        max_epochs (int):                 max nbr of epochs for a single model.
+        batch_size (int):                 training batch size.
+        oracle_port (int):                port of the chief oracle.
+        overwrite (bool):                 delete an existing project instead of resuming its search.
+    """
+    # Delete the project before the workers open it, otherwise the chief oracle reloads it
+    project_dir = os.path.join(str(directory), project_name)
+    if overwrite and tf.io.gfile.exists(project_dir):
+        tf.io.gfile.rmtree(project_dir)
+
+    oracle_env = {'KERASTUNER_ORACLE_IP': '127.0.0.1', 'KERASTUNER_ORACLE_PORT': str(oracle_port)}
+    # Spawn to avoid forking an initialized tensorflow runtime
+    ctx = multiprocessing.get_context('spawn')
+    chief = _start_process(ctx, _run_tuning_chief, (model_name, max_epochs, directory, project_name),
+                           dict(oracle_env, KERASTUNER_TUNER_ID='chief'))
+    processes = [_start_process(ctx, _run_tuning_worker,
+                                (threads_per_worker, model_name, max_epochs, directory, project_name,
+                                 dataset_filepaths, batch_size),
+                                dict(oracle_env, KERASTUNER_TUNER_ID='tuner' + str(i),
+                                     OMP_NUM_THREADS=str(threads_per_worker)))
+                 for i in range(workers)]
+    try:
+        running = list(processes)
+        while running:
+            wait([p.sentinel for p in running] + [chief.sentinel])
+            if not chief.is_alive():
+                raise RuntimeError("Tuning chief oracle exited with code " + str(chief.exitcode))
+            for p in [p for p in running if not p.is_alive()]:
+                if p.exitcode != 0:
+                    raise RuntimeError("Tuning worker exited with code " + str(p.exitcode))
+                running.remove(p)
+    finally:
+        for p in processes + [chief]:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+    # Reload the search results saved by the chief oracle
+    tuner = get_tuner(model_name, max_epochs, directory, project_name)
+    save_timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    losses = []
+    for trial_id in tuner.oracle.trials:
+        results_fname = os.path.join(tuner.get_trial_dir(trial_id), TRIAL_RESULTS_FNAME)
+        if not os.path.exists(results_fname):
+            continue
+        with open(results_fname) as f:
+            results = json.load(f)
+        losses.append(Loss(model=model_name,
+                           save_timestamp=save_timestamp,
+                           loss_name='val_loss',
+                           loss=results['val_loss'],
+                           trial_id=trial_id,
+                           trial_time_seconds=results['seconds']))
+    return tuner, losses